@@ -1,5 +1,4 @@
 import collections
-import io
 import sys
 import time
 
@@ -28,7 +27,9 @@ class Config(collections.namedtuple('Config', [
         Parses stdin in KLV format to get the benchmark configuration.
         This raises an exception if the format is invalid.
         '''
-        c = Config(
+        # We collect fields into a dict and build the config once at the end,
+        # instead of rebuilding the tuple with '_replace' for every item.
+        fields = dict(
             name='',
             model='',
             patterns=[],
@@ -41,32 +42,32 @@ class Config(collections.namedtuple('Config', [
             max_warmup_time=0,
         )
         raw = sys.stdin.buffer.read()
-        while len(raw) > 0:
-            klv, nread = OneKLV.parse(raw)
-            raw = raw[nread:]
+        pos = 0
+        while pos < len(raw):
+            klv, pos = OneKLV.parse(raw, pos)
             if klv.key == 'name':
-                c = c._replace(name=klv.value.decode('utf-8'))
+                fields['name'] = klv.value.decode('utf-8')
             elif klv.key == 'model':
-                c = c._replace(model=klv.value.decode('utf-8'))
+                fields['model'] = klv.value.decode('utf-8')
             elif klv.key == 'pattern':
-                c.patterns.append(klv.value.decode('utf-8'))
+                fields['patterns'].append(klv.value.decode('utf-8'))
             elif klv.key == 'case-insensitive':
-                c = c._replace(case_insensitive=klv.value == b'true')
+                fields['case_insensitive'] = klv.value == b'true'
             elif klv.key == 'unicode':
-                c = c._replace(unicode=klv.value == b'true')
+                fields['unicode'] = klv.value == b'true'
             elif klv.key == 'haystack':
-                c = c._replace(haystack=klv.value)
+                fields['haystack'] = klv.value
             elif klv.key == 'max-iters':
-                c = c._replace(max_iters=int(klv.value))
+                fields['max_iters'] = int(klv.value)
             elif klv.key == 'max-warmup-iters':
-                c = c._replace(max_warmup_iters=int(klv.value))
+                fields['max_warmup_iters'] = int(klv.value)
             elif klv.key == 'max-time':
-                c = c._replace(max_time=int(klv.value))
+                fields['max_time'] = int(klv.value)
             elif klv.key == 'max-warmup-time':
-                c = c._replace(max_warmup_time=int(klv.value))
+                fields['max_warmup_time'] = int(klv.value)
             else:
                 raise ValueError(f"unrecognized KLV item key '{klv.key}'")
-        return c
+        return Config(**fields)
 
     def get_haystack(self):
         '''
@@ -122,10 +123,11 @@ class Config(collections.namedtuple('Config', [
         flags = 0  # should be re.NOFLAG if we required Python 3.11
         if self.case_insensitive:
             flags |= re.IGNORECASE
+        # When Unicode is disabled, all of our patterns are 'bytes', and both
+        # the 're' and 'regex' modules always treat 'bytes' patterns as ASCII.
+        # So there's no need to ask for it explicitly.
         if self.unicode:
             flags |= re.UNICODE
-        else:
-            flags |= re.ASCII
         return flags
 
     def maybe_bytes(self, s):
@@ -145,26 +147,33 @@ class Config(collections.namedtuple('Config', [
 
 class OneKLV(collections.namedtuple('OneKLV', ['key', 'value'])):
     @staticmethod
-    def parse(raw):
-        assert isinstance(raw, bytes)
+    def parse(raw, start):
+        '''
+        Parses a single KLV item from 'raw' beginning at offset 'start'.
+        This returns the item along with the offset immediately following
+        it.
 
-        pieces = raw.split(b':', 2)
-        if len(pieces) < 3:
+        Offsets are used instead of slicing off what has been read so far,
+        since the latter would copy the (possibly very large) remainder of
+        'raw' for every item.
+        '''
+        key_end = raw.find(b':', start)
+        len_end = -1 if key_end == -1 else raw.find(b':', key_end + 1)
+        if len_end == -1:
             raise ValueError("invalid KLV item: not enough pieces")
-        key = pieces[0].decode('utf-8')
-        value_len = int(pieces[1])
-        rest = pieces[2]
-        if len(rest) < value_len:
+        key = raw[start:key_end].decode('utf-8')
+        value_len = int(raw[key_end + 1:len_end])
+        value_start = len_end + 1
+        value_end = value_start + value_len
+        if len(raw) < value_end:
             raise ValueError(
                 f"not enough bytes remaining for length "
                 f"{value_len} for key '{key}'",
             )
-        value = rest[:value_len]
-        rest = rest[value_len:]
-        if len(rest) == 0 or rest[0:1] != b'\n':
+        if raw[value_end:value_end + 1] != b'\n':
             raise ValueError(f"did not find \\n after value for key '{key}'")
-        nread = len(pieces[0]) + 1 + len(pieces[1]) + 1 + len(value) + 1
-        return OneKLV(key=key, value=value), nread
+        value = raw[value_start:value_end]
+        return OneKLV(key=key, value=value), value_end + 1
 
 
 def model_compile(c):
@@ -175,26 +184,36 @@ def model_compile(c):
     def bench():
         return re.compile(p, flags)
     def count(r):
-        return sum(1 for _ in r.finditer(h))
-    return run_and_count(c, count, bench)
+        return len(r.findall(h))
+    return run_and_count(c, count, bench, purge=True)
 
 
 def model_count(c):
     '''Implements the 'count' rebar benchmark model.'''
     r = c.get_one_regex()
     h = c.get_haystack()
-    return run(c, lambda: sum(1 for _ in r.finditer(h)))
+    # 'findall' builds its list of matches entirely in C, which makes it
+    # quite a bit faster than iterating over 'finditer' in Python. The list
+    # contains tuples instead of strings when the regex has capture groups,
+    # but either way, its length is the number of matches.
+    return run(c, lambda: len(r.findall(h)))
 
 
 def model_count_spans(c):
     '''Implements the 'count-spans' rebar benchmark model.'''
     r = c.get_one_regex()
     h = c.get_haystack()
-    def bench():
-        if c.unicode:
+    # When searching bytes, we can compute the length of each match from its
+    # offsets without creating a new object for every match. For 'str'
+    # haystacks, the offsets are in units of codepoints, but we want lengths
+    # in bytes. Those are only the same when the haystack is ASCII, so in all
+    # other cases, we fall back to encoding each match.
+    if c.unicode and not c.haystack.isascii():
+        def bench():
             return sum(len(m.group(0).encode('utf-8')) for m in r.finditer(h))
-        else:
-            return sum(len(m.group(0)) for m in r.finditer(h))
+    else:
+        def bench():
+            return sum(m.end() - m.start() for m in r.finditer(h))
     return run(c, bench)
 
 
@@ -202,11 +221,15 @@ def model_count_captures(c):
     '''Implements the 'count-captures' rebar benchmark model.'''
     r = c.get_one_regex()
     h = c.get_haystack()
+    finditer = r.finditer
+    # Counting the groups that didn't participate with 'tuple.count' keeps
+    # the loop over groups in C.
+    ngroups = r.groups
     def bench():
         count = 0
-        for m in r.finditer(h):
+        for m in finditer(h):
             # Add 1 to account for implicit capture group.
-            count += 1 + sum(1 for g in m.groups() if g is not None)
+            count += 1 + ngroups - m.groups().count(None)
         return count
     return run(c, bench)
 
@@ -215,8 +238,9 @@ def model_grep(c):
     '''Implements the 'grep' rebar benchmark model.'''
     r = c.get_one_regex()
     h = c.get_haystack()
+    nl, cr = c.maybe_bytes('\n'), c.maybe_bytes('\r')
+    search = r.search
     def bench():
-        hay = h
         count = 0
         # N.B. I tried using io.StringIO here to avoid loading all of the
         # lines into memory first, but it doesn't seem to make a difference.
@@ -226,13 +250,22 @@ def model_grep(c):
         #
         # We don't use 'splitlines' here because it splits on more than just
         # LF and CRLF.
-        lines = h.split(c.maybe_bytes('\n'))
-        if len(lines) > 0 and len(lines[len(lines)-1]) == 0:
-            lines = lines[:len(lines)-1]
+        #
+        # Finally, one might be tempted to run a single search over the entire
+        # haystack and map each match back to its line. But that changes the
+        # meaning of things like '^', '$' and look-around, and permits matches
+        # that span lines. The model requires searching each line on its own.
+        lines = h.split(nl)
+        if lines and not lines[-1]:
+            lines.pop()
         for line in lines:
-            if line.endswith(c.maybe_bytes('\r')):
-                line = line[0:len(line)-1]
-            if r.search(line):
+            # Instead of slicing off the '\r' (which copies the line), we just
+            # tell the regex engine to stop before it. This behaves as if the
+            # line were actually that long, so things like '$' still work.
+            end = len(line)
+            if line.endswith(cr):
+                end -= 1
+            if search(line, 0, end):
                 count += 1
         return count
     return run(c, bench)
@@ -242,36 +275,32 @@ def model_grep_captures(c):
     '''Implements the 'grep-captures' rebar benchmark model.'''
     r = c.get_one_regex()
     h = c.get_haystack()
+    nl, cr = c.maybe_bytes('\n'), c.maybe_bytes('\r')
+    finditer = r.finditer
+    # See 'model_count_captures' for why we count groups this way.
+    ngroups = r.groups
     def bench():
         count = 0
-        lines = h.split(c.maybe_bytes('\n'))
-        if len(lines) > 0 and len(lines[len(lines)-1]) == 0:
-            lines = lines[:len(lines)-1]
+        lines = h.split(nl)
+        if lines and not lines[-1]:
+            lines.pop()
+        # See 'model_grep' for why we search each line on its own and don't
+        # slice off the '\r'.
         for line in lines:
-            if line.endswith(c.maybe_bytes('\r')):
-                line = line[0:len(line)-1]
-            for m in r.finditer(line):
+            end = len(line)
+            if line.endswith(cr):
+                end -= 1
+            for m in finditer(line, 0, end):
                 # Add 1 to account for implicit capture group.
-                count += 1 + sum(1 for g in m.groups() if g is not None)
+                count += 1 + ngroups - m.groups().count(None)
         return count
     return run(c, bench)
 
 
 def model_regex_redux(c):
     '''Implements the 'regex-redux' rebar benchmark model.'''
-    def maybe_bytes(s):
-        '''
-        When 's' is a Unicode string and Unicode is disabled for this
-        benchmark, then return it as a UTF-8 encoded byte string.
-        Otherwise return 's' unchanged.
-
-        This is useful for letting us just use regular string literals
-        below, and then this function will convert it to a byte string
-        if needed.
-        '''
-        if not c.unicode and isinstance(s, str):
-            return s.encode('utf-8')
-        return s
+    maybe_bytes = c.maybe_bytes
+    flags = c.get_re_flags()
 
     def verify(output):
         '''Raise an exception if 'output' is incorrect.'''
@@ -296,20 +325,14 @@ agggtaa[cgt]|[acg]ttaccct 43
 
     def regex(pattern):
         '''Compile the given regex pattern.'''
-        return re.compile(maybe_bytes(pattern), c.get_re_flags())
-
-    def bench():
-        '''Run a single iteration of the regex-redux benchmark.'''
-        if c.unicode:
-            out = io.StringIO()
-        else:
-            out = io.BytesIO()
-        seq = c.get_haystack()
-        ilen = len(seq)
-        seq = regex(r">[^\n]*\n|\n").sub(maybe_bytes(''), seq)
-        clen = len(seq)
-
-        variants = [
+        return re.compile(pattern, flags)
+
+    # The patterns and replacements are converted to the right string type
+    # up front. We still compile each regex inside 'bench' though, since
+    # compilation is part of what this model measures.
+    flatten = maybe_bytes(r">[^\n]*\n|\n")
+    variants = [
+        (variant, maybe_bytes(variant)) for variant in [
             r"agggtaaa|tttaccct",
             r"[cgt]gggtaaa|tttaccc[acg]",
             r"a[act]ggtaaa|tttacc[agt]t",
@@ -320,24 +343,54 @@ agggtaa[cgt]|[acg]ttaccct 43
             r"agggta[cgt]a|t[acg]taccct",
             r"agggtaa[cgt]|[acg]ttaccct",
         ]
-        for variant in variants:
-            count = sum(1 for _ in regex(variant).finditer(seq))
-            out.write(maybe_bytes(f'{variant} {count}\n'))
-
-        substs = [
-            (regex(r"tHa[Nt]"), "<4>"),
-            (regex(r"aND|caN|Ha[DS]|WaS"), "<3>"),
-            (regex(r"a[NSt]|BY"), "<2>"),
-            (regex(r"<[^>]*>"), "|"),
-            (regex(r"\|[^|][^|]*\|"), "-"),
+    ]
+    substs = [
+        (maybe_bytes(pattern), maybe_bytes(replacement))
+        for (pattern, replacement) in [
+            (r"tHa[Nt]", "<4>"),
+            (r"aND|caN|Ha[DS]|WaS", "<3>"),
+            (r"a[NSt]|BY", "<2>"),
+            (r"<[^>]*>", "|"),
+            (r"\|[^|][^|]*\|", "-"),
         ]
-        for (r, replacement) in substs:
-            seq = r.sub(maybe_bytes(replacement), seq)
-        out.write(maybe_bytes(f'\n{ilen}\n{clen}\n{len(seq)}\n'))
-        verify(out.getvalue())
-        return len(seq)
+    ]
+    empty = maybe_bytes('')
+    # Get the haystack outside of 'bench', since in Unicode mode, this
+    # decodes the entire haystack and that shouldn't be measured.
+    haystack = c.get_haystack()
 
-    return run(c, bench)
+    def bench():
+        '''Run a single iteration of the regex-redux benchmark.'''
+        out = []
+        seq = haystack
+        ilen = len(seq)
+        seq = regex(flatten).sub(empty, seq)
+        clen = len(seq)
+
+        for (variant, pattern) in variants:
+            count = len(regex(pattern).findall(seq))
+            out.append(f'{variant} {count}')
+
+        # N.B. It's tempting to fuse some of these substitutions into a single
+        # alternation to save passes over 'seq'. But each substitution is
+        # applied to the output of the previous one, and a single leftmost-first
+        # pass gives different results. (e.g., 'atHaN' becomes 'a<4>' when
+        # done in sequence, but '<2>H<2>' when fused.)
+        for (pattern, replacement) in substs:
+            seq = regex(pattern).sub(replacement, seq)
+        out.extend(['', str(ilen), str(clen), str(len(seq))])
+        return maybe_bytes('\n'.join(out) + '\n'), len(seq)
+
+    def count(result):
+        '''Verify the output of 'bench' and return its final length.'''
+        output, length = result
+        verify(output)
+        return length
+
+    # Verification happens in 'count' so that it isn't measured. We purge the
+    # regex cache before each iteration since compiling the regexes is part
+    # of what this model measures.
+    return run_and_count(c, count, bench, purge=True)
 
 
 def run(c, bench):
@@ -350,10 +403,10 @@ def run(c, bench):
     The 'bench' function must return a count of the number of regex
     matches.
     '''
-    return run_and_count(c, lambda count: count, bench)
+    return run_and_count(c, None, bench)
 
 
-def run_and_count(c, count, bench):
+def run_and_count(c, count, bench, purge=False):
     '''
     Like 'run', but also accepts a 'count' function that accepts the
     return value of 'bench' and must return a count of the number
@@ -364,38 +417,56 @@ def run_and_count(c, count, bench):
     The purpose of this setup is so that 'count' (which is used to
     verify the benchmark) is separate from 'bench' (which is what is
     actually measured).
+
+    If 'count' is None, then the return value of 'bench' is used as the
+    count directly. This avoids an extra function call per iteration for
+    models that don't need a separate 'count' step.
+
+    When 'purge' is true, the regex module's cache is cleared before
+    each iteration. This should be enabled for models that measure
+    regex compilation.
     '''
-    warmup_start = time.time_ns()
-    for _ in range(c.max_warmup_iters):
-        # See comment below for why we do this.
-        re.purge()
-        result = bench()
-        _count = count(result)
-        if (time.time_ns() - warmup_start) >= c.max_warmup_time:
-            break
+    # We use a monotonic clock since we only care about elapsed time, and
+    # bind it to a local to avoid looking it up on every iteration.
+    now = time.perf_counter_ns
+    # Note that when 'max_warmup_time' is zero but 'max_warmup_iters' isn't,
+    # we still run one warmup iteration. This matches the other runners.
+    if c.max_warmup_iters > 0:
+        warmup_deadline = now() + c.max_warmup_time
+        for _ in range(c.max_warmup_iters):
+            # See comment below for why we do this.
+            if purge:
+                re.purge()
+            result = bench()
+            if count is not None:
+                _count = count(result)
+            if now() >= warmup_deadline:
+                break
 
     results = []
-    run_start = time.time_ns()
+    run_deadline = now() + c.max_time
     for _ in range(c.max_iters):
         # Purge's the re module's regex cache, otherwise we wind up just
         # measuring how long it takes to fetch a regex from its internal cache.
-        # Technically, this is only necessary for the 'compile' model, but it's
-        # easier to just do it here so that our 'compile' model doesn't wind up
-        # measuring the time it takes to clear the cache and compile the regex.
+        # This is only necessary for models that compile regexes as part of
+        # what they measure, i.e., 'compile' and 'regex-redux'. We do it here
+        # instead of in 'bench' so that we don't wind up measuring the time it
+        # takes to clear the cache.
         #
-        # I've tried search-only benchmarks with and without this purge step
-        # and I can't see any measureable difference. In theory, this *could*
-        # result in a difference if the cache contains more than just a static
-        # compile regex object, but that depends on the implementation of
-        # which I am not familiar. If that is indeed the case, we'll want to
-        # re-orient how this program is structured so that purging only happens
-        # in the 'compile' model implementation.
-        re.purge()
-        bench_start = time.time_ns()
+        # Other models don't purge at all, since it only adds per-iteration
+        # overhead that can show up in benchmarks with very short iterations.
+        if purge:
+            re.purge()
+        bench_start = now()
         result = bench()
-        elapsed = time.time_ns() - bench_start
-        results.append((elapsed, count(result)))
-        if (time.time_ns() - run_start) >= c.max_time:
+        bench_end = now()
+        if count is not None:
+            result = count(result)
+        results.append((bench_end - bench_start, result))
+        # We reuse the time at which 'bench' finished instead of asking the
+        # clock again. This means the time spent in 'count' on this iteration
+        # isn't accounted for, but it will be on the next one.
+        if bench_end >= run_deadline:
             break
     return results
 